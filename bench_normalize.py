@@ -0,0 +1,58 @@
+import sys
+import time
+
+from PIL import Image
+
+from image_ops import normalize_mode
+
+
+def make_sample(mode, size):
+    """生成指定模式的测试图像（带渐变，避免全图同色被优化）"""
+    gradient = Image.linear_gradient("L").resize(size)
+    if mode == "RGBA":
+        return Image.merge("RGBA", (gradient, gradient.rotate(90), gradient.rotate(180), gradient.rotate(270)))
+    if mode == "LA":
+        return Image.merge("LA", (gradient, gradient.rotate(90)))
+    if mode == "PA":
+        return Image.merge("RGBA", (gradient, gradient, gradient, gradient.rotate(90))).convert("PA")
+    if mode == "P":
+        img = gradient.convert("P")
+        img.info["transparency"] = 0
+        return img
+    if mode == "I;16":
+        return gradient.convert("I").point(lambda v: v * 257).convert("I;16")
+    if mode == "CMYK":
+        return Image.merge("RGB", (gradient, gradient.rotate(90), gradient.rotate(180))).convert("CMYK")
+    return gradient.convert(mode)
+
+
+def bench(mode, save_format, size, rounds):
+    """返回每百万像素的平均耗时（毫秒）"""
+    img = make_sample(mode, size)
+    img.load()
+    normalize_mode(img, save_format)  # 预热
+    start = time.perf_counter()
+    for _ in range(rounds):
+        normalize_mode(img, save_format)
+    elapsed = time.perf_counter() - start
+    megapixels = size[0] * size[1] / 1_000_000
+    return elapsed / rounds / megapixels * 1000
+
+
+def main():
+    side = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    size = (side, side)
+
+    print("=" * 50)
+    print(f"模式归一化基准测试: {side}x{side}, 每项 {rounds} 轮")
+    print("=" * 50)
+    for save_format in ("JPEG", "WEBP"):
+        for mode in ("RGB", "RGBA", "LA", "PA", "P", "I;16", "CMYK"):
+            cost = bench(mode, save_format, size, rounds)
+            print(f"{save_format:<5} {mode:<5} {cost:8.2f} ms/MP")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
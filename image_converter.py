@@ -1,11 +1,15 @@
 import os
-import shutil
 from PIL import Image, UnidentifiedImageError
 import pillow_avif  # 插件自动注册支持AVIF
+from image_ops import (
+    DEFAULT_BACKGROUND, ERROR_DIR_NAME, FORMAT_MAP, backup_failed, encode_image, output_name
+)
+from output_sink import DEFAULT_SINK, SinkError, available_sinks, create_sink
 from PySide6.QtWidgets import (
     QApplication, QWidget, QPushButton, QLabel, QFileDialog,
     QVBoxLayout, QHBoxLayout, QComboBox, QSlider, QProgressBar, QMessageBox, QTextEdit,
-    QGroupBox, QRadioButton, QButtonGroup, QLineEdit, QSizePolicy, QSpacerItem, QSplitter
+    QGroupBox, QRadioButton, QButtonGroup, QLineEdit, QSizePolicy, QSpacerItem, QSplitter,
+    QColorDialog
 )
 from PySide6.QtCore import Qt, QThread, Signal
 from PySide6.QtGui import QFont, QTextCursor, QTextCharFormat, QColor, QPalette, QIcon
@@ -16,19 +20,20 @@ class ConverterThread(QThread):
     status = Signal(str, str)  # 参数1: 消息类型, 参数2: 消息内容
     finished = Signal(int, int, int, str, str, str)
 
-    def __init__(self, files, fmt, mode, quality, out_dir):
+    def __init__(self, files, fmt, mode, quality, out_dir, background=DEFAULT_BACKGROUND,
+                 sink_kind=DEFAULT_SINK):
         super().__init__()
         self.files = files
         self.format = fmt
         self.mode = mode
         self.quality = quality
         self.out_dir = out_dir
+        self.background = background
+        self.sink_kind = sink_kind
         self.is_running = True
 
     def run(self):
         total = len(self.files)
-        success = 0
-        fail = 0
         
         # 确定错误目录位置
         if self.mode == "覆盖":
@@ -36,25 +41,61 @@ class ConverterThread(QThread):
         else:
             base_dir = self.out_dir
         
-        err_dir = os.path.join(base_dir, "处理错误")
+        err_dir = os.path.join(base_dir, ERROR_DIR_NAME)
         os.makedirs(err_dir, exist_ok=True)
         
         self.status.emit("info", f"🛠️ 开始处理 {total} 个图片文件...")
         self.status.emit("info", f"🔄 输出格式: {self.format}")
         self.status.emit("info", f"📁 保存方式: {self.mode}")
+        sink = None
         if self.mode == "路径选择":
             self.status.emit("info", f"📂 输出目录: {self.out_dir}")
+            try:
+                sink = create_sink(self.sink_kind, self.out_dir, self._source_root())
+            except (OSError, ValueError) as e:
+                self.status.emit("error", f"❌ 无法创建输出目标: {e}")
+                self.finished.emit(total, 0, 0, self.out_dir, err_dir, os.path.dirname(self.files[0]))
+                return
+            if self.sink_kind != DEFAULT_SINK:
+                self.status.emit("info", f"🗜️ 输出归档: {sink.location}")
         self.status.emit("info", f"⚖️ 图片质量: {self.quality}%")
+        if self.format == "JPG":
+            self.status.emit("info", f"🎨 透明背景填充色: #{'%02x%02x%02x' % tuple(self.background)}")
         self.status.emit("info", f"⚠️ 错误文件将保存到: {err_dir}")
         self.status.emit("info", "="*60)
         
-        # 映射格式到Pillow的格式标识符
-        format_map = {
-            "JPG": "JPEG",
-            "WEBP": "WEBP",
-            "AVIF": "AVIF"
-        }
-        save_format = format_map.get(self.format, self.format)
+        save_format = FORMAT_MAP.get(self.format, self.format)
+
+        try:
+            success, fail = self._convert_all(save_format, sink, err_dir)
+        finally:
+            # 归档目标需要关闭才会写入清单并生成最终文件
+            if sink is not None:
+                try:
+                    sink.close()
+                except OSError as e:
+                    self.status.emit("error", f"❌ 输出目标关闭失败: {e}")
+                if sink.failed:
+                    self.status.emit("error", f"⚠️ 归档未完成，已保留为: {sink.location}")
+
+        out_location = sink.location if sink is not None else self.out_dir
+        self.finished.emit(total, success, fail, out_location, err_dir, os.path.dirname(self.files[0]))
+        self.status.emit("info", "="*60)
+        self.status.emit("info", "✨ 处理完成！")
+
+    def _source_root(self):
+        """所有输入文件的公共目录，清单中的源路径相对该目录记录"""
+        try:
+            return os.path.commonpath([os.path.dirname(f) for f in self.files])
+        except ValueError:
+            # 输入文件分布在不同盘符
+            return ""
+
+    def _convert_all(self, save_format, sink, err_dir):
+        """逐个转换文件，返回 (成功数, 失败数)"""
+        total = len(self.files)
+        success = 0
+        fail = 0
 
         for idx, filepath in enumerate(self.files, 1):
             if not self.is_running:
@@ -65,58 +106,52 @@ class ConverterThread(QThread):
                 self.status.emit("processing", f"🔧 正在处理 {idx}/{total}: {filename}...")
                 
                 with Image.open(filepath) as img:
-                    base_name = os.path.splitext(filename)[0]
                     file_ext = os.path.splitext(filename)[1].lower().replace(".", "")
+                    out_name = output_name(filepath, self.format)
                     
-                    # 确定目标目录和输出路径
-                    if self.mode == "覆盖":
+                    if sink is not None:
+                        # 如果输出目标中已有同名文件，则跳过
+                        if sink.exists(out_name):
+                            self.status.emit("info", f"ℹ️ 跳过: {filename} (目标文件已存在)")
+                            continue
+                        
+                        sink.write(out_name, encode_image(img, save_format, self.quality, self.background), filepath)
+                        self.status.emit("success", f"✅ 成功: {filename} → {out_name}")
+                        success += 1
+                    else:
+                        # 覆盖模式：如果格式相同，则直接覆盖原文件
                         target_dir = os.path.dirname(filepath)
-                        # 如果格式相同，则直接覆盖原文件
                         if file_ext == self.format.lower():
                             out_path = filepath
                         else:
-                            out_path = os.path.join(target_dir, f"{base_name}.{self.format.lower()}")
-                    else:
-                        target_dir = self.out_dir
-                        out_path = os.path.join(target_dir, f"{base_name}.{self.format.lower()}")
-                    
-                    # 确保目录存在
-                    os.makedirs(target_dir, exist_ok=True)
-                    
-                    # 如果目标文件已存在且与源文件相同，则跳过
-                    if out_path != filepath and os.path.exists(out_path):
-                        self.status.emit("info", f"ℹ️ 跳过: {filename} (目标文件已存在)")
-                        continue
-                    
-                    # 特殊处理JPG格式
-                    if save_format == "JPEG":
-                        # 将图像转换为RGB模式（JPEG不支持透明通道）
-                        if img.mode in ('RGBA', 'LA', 'P'):
-                            img = img.convert('RGB')
-                        # 保存JPEG图像
-                        img.save(out_path, format=save_format, quality=self.quality, optimize=True)
-                    else:
-                        # 保存其他格式图像
-                        img.save(out_path, format=save_format, quality=self.quality)
-                    
-                    # 如果是覆盖模式且格式改变，删除原文件
-                    if self.mode == "覆盖" and out_path != filepath:
-                        os.remove(filepath)
-                        self.status.emit("success", f"✅ 成功: {filename} → {os.path.basename(out_path)}")
-                    else:
-                        self.status.emit("success", f"✅ 成功: {filename} (已更新)")
-                    
-                    success += 1
+                            out_path = os.path.join(target_dir, out_name)
+                        
+                        # 如果目标文件已存在且与源文件不同，则跳过
+                        if out_path != filepath and os.path.exists(out_path):
+                            self.status.emit("info", f"ℹ️ 跳过: {filename} (目标文件已存在)")
+                            continue
+                        
+                        data = encode_image(img, save_format, self.quality, self.background)
+                        with open(out_path, "wb") as f:
+                            f.write(data)
+                        
+                        # 格式改变时删除原文件
+                        if out_path != filepath:
+                            os.remove(filepath)
+                            self.status.emit("success", f"✅ 成功: {filename} → {os.path.basename(out_path)}")
+                        else:
+                            self.status.emit("success", f"✅ 成功: {filename} (已更新)")
+                        
+                        success += 1
                     
-            except (UnidentifiedImageError, OSError, ValueError) as e:
-                error_filename = f"error_{filename}"
-                error_path = os.path.join(err_dir, error_filename)
+            except SinkError as e:
+                # 归档写入失败后继续追加只会得到损坏的归档，直接停止
+                self.status.emit("error", f"❌ {e}，停止处理: {filename}")
+                fail += 1
+                break
                 
-                try:
-                    shutil.copy(filepath, error_path)
-                    self.status.emit("error", f"❌ 处理失败: {filename} (已备份到错误目录)")
-                except:
-                    self.status.emit("error", f"❌ 处理失败且无法备份: {filename}")
+            except (UnidentifiedImageError, OSError, ValueError) as e:
+                backup_failed(filepath, err_dir, lambda message: self.status.emit("error", message))
                 
                 # 记录错误详情
                 error_detail = f"错误类型: {type(e).__name__}\n错误信息: {str(e)}"
@@ -126,9 +161,7 @@ class ConverterThread(QThread):
             progress_percent = int((idx / total) * 100)
             self.progress.emit(progress_percent)
 
-        self.finished.emit(total, success, fail, self.out_dir, err_dir, os.path.dirname(self.files[0]))
-        self.status.emit("info", "="*60)
-        self.status.emit("info", "✨ 处理完成！")
+        return success, fail
 
     def stop(self):
         self.is_running = False
@@ -201,6 +234,7 @@ class ImageConverterApp(QWidget):
 
         self.selected_files = []
         self.output_path = ""
+        self.background = DEFAULT_BACKGROUND
         self.thread = None
 
         # 创建主布局
@@ -238,6 +272,15 @@ class ImageConverterApp(QWidget):
         self.format_combo.addItems(["JPG", "WEBP", "AVIF"])
         self.format_combo.setFixedWidth(140)
         format_layout.addWidget(self.format_combo)
+        
+        # 透明背景填充色（仅JPG有效）
+        format_layout.addWidget(QLabel("透明背景:"))
+        self.background_button = QPushButton()
+        self.background_button.setFixedWidth(60)
+        self.background_button.setToolTip("JPG不支持透明通道，透明区域将填充为此颜色")
+        self.background_button.clicked.connect(self.select_background)
+        format_layout.addWidget(self.background_button)
+        self.update_background_button()
         format_layout.addItem(QSpacerItem(20, 20, QSizePolicy.Expanding, QSizePolicy.Minimum))
         
         settings_layout.addLayout(format_layout)
@@ -272,6 +315,20 @@ class ImageConverterApp(QWidget):
         
         settings_layout.addLayout(path_layout)
 
+        # 输出方式（仅选择保存路径时有效）
+        sink_layout = QHBoxLayout()
+        sink_layout.addWidget(QLabel("输出方式:"))
+        
+        self.sink_combo = QComboBox()
+        self.sink_combo.addItems(available_sinks())
+        self.sink_combo.setFixedWidth(140)
+        self.sink_combo.setToolTip("选择归档时，所有结果会写入输出文件夹中的一个归档文件")
+        self.sink_combo.setEnabled(False)  # 默认禁用
+        sink_layout.addWidget(self.sink_combo)
+        sink_layout.addItem(QSpacerItem(20, 20, QSizePolicy.Expanding, QSizePolicy.Minimum))
+        
+        settings_layout.addLayout(sink_layout)
+
         # 质量滑块
         quality_layout = QVBoxLayout()
         quality_layout.addWidget(QLabel("图片质量"))
@@ -360,17 +417,38 @@ class ImageConverterApp(QWidget):
         self.mode_overwrite.toggled.connect(self.mode_changed)
         self.mode_select_path.toggled.connect(self.mode_changed)
         self.quality_slider.valueChanged.connect(self.quality_changed)
+        self.format_combo.currentTextChanged.connect(self.format_changed)
 
     def mode_changed(self):
         """处理模式改变时的UI更新"""
         if self.mode_select_path.isChecked():
             self.path_button.setEnabled(True)
+            self.sink_combo.setEnabled(True)
             self.path_display.setPlaceholderText("请选择输出文件夹")
         else:
             self.path_button.setEnabled(False)
+            self.sink_combo.setEnabled(False)
             self.path_display.clear()
             self.path_display.setPlaceholderText("选择路径或使用覆盖模式")
 
+    def format_changed(self, fmt):
+        """目标格式改变时的UI更新"""
+        self.background_button.setEnabled(fmt == "JPG")
+
+    def select_background(self):
+        """选择透明背景填充色"""
+        color = QColorDialog.getColor(QColor(*self.background), self, "选择透明背景填充色")
+        if color.isValid():
+            self.background = (color.red(), color.green(), color.blue())
+            self.update_background_button()
+
+    def update_background_button(self):
+        """用当前背景色刷新按钮样式"""
+        hex_color = "#%02x%02x%02x" % tuple(self.background)
+        self.background_button.setStyleSheet(
+            f"background-color: {hex_color}; border: 1px solid #888888;"
+        )
+
     def quality_changed(self, value):
         """质量滑块值改变时的更新"""
         self.quality_value.setText(f"{value}%")
@@ -423,6 +501,7 @@ class ImageConverterApp(QWidget):
         mode = "路径选择" if self.mode_select_path.isChecked() else "覆盖"
         quality = self.quality_slider.value()
         out_dir = self.output_path if mode == "路径选择" else ""
+        sink_kind = self.sink_combo.currentText()
         
         # 清空日志
         self.log_text.clear()
@@ -432,13 +511,16 @@ class ImageConverterApp(QWidget):
         self.cancel_button.setEnabled(True)
         self.select_button.setEnabled(False)
         self.path_button.setEnabled(False)
+        self.sink_combo.setEnabled(False)
         self.mode_overwrite.setEnabled(False)
         self.mode_select_path.setEnabled(False)
         self.quality_slider.setEnabled(False)
         self.format_combo.setEnabled(False)
+        self.background_button.setEnabled(False)
         
         # 创建并启动线程
-        self.thread = ConverterThread(self.selected_files, fmt, mode, quality, out_dir)
+        self.thread = ConverterThread(self.selected_files, fmt, mode, quality, out_dir, self.background,
+                                      sink_kind)
         self.thread.progress.connect(self.progress_bar.setValue)
         self.thread.status.connect(self.update_log)
         self.thread.finished.connect(self.on_finished)
@@ -493,10 +575,12 @@ class ImageConverterApp(QWidget):
         self.cancel_button.setEnabled(False)
         self.select_button.setEnabled(True)
         self.path_button.setEnabled(self.mode_select_path.isChecked())
+        self.sink_combo.setEnabled(self.mode_select_path.isChecked())
         self.mode_overwrite.setEnabled(True)
         self.mode_select_path.setEnabled(True)
         self.quality_slider.setEnabled(True)
         self.format_combo.setEnabled(True)
+        self.background_button.setEnabled(self.format_combo.currentText() == "JPG")
         
         self.append_log("info", "🚫 转换已取消")
         self.append_log("info", "=" * 60)
@@ -508,10 +592,12 @@ class ImageConverterApp(QWidget):
         self.cancel_button.setEnabled(False)
         self.select_button.setEnabled(True)
         self.path_button.setEnabled(self.mode_select_path.isChecked())
+        self.sink_combo.setEnabled(self.mode_select_path.isChecked())
         self.mode_overwrite.setEnabled(True)
         self.mode_select_path.setEnabled(True)
         self.quality_slider.setEnabled(True)
         self.format_combo.setEnabled(True)
+        self.background_button.setEnabled(self.format_combo.currentText() == "JPG")
         
         # 显示结果摘要
         self.append_log("info", "=" * 60)
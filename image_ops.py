@@ -0,0 +1,142 @@
+import io
+import os
+import shutil
+
+from PIL import Image, ImageCms
+
+
+# JPEG 不支持透明通道时使用的默认背景色（白色）
+DEFAULT_BACKGROUND = (255, 255, 255)
+
+# 处理失败的源文件备份目录名
+ERROR_DIR_NAME = "处理错误"
+
+# 映射格式到Pillow的格式标识符
+FORMAT_MAP = {
+    "JPG": "JPEG",
+    "WEBP": "WEBP",
+    "AVIF": "AVIF"
+}
+
+# 各输出格式可直接保存的图像模式
+_ALPHA_FORMATS = {"WEBP", "AVIF"}
+_JPEG_MODES = ("RGB", "L")
+
+
+def _has_alpha(img):
+    """判断图像是否带有透明信息（包括调色板/颜色键透明）"""
+    return img.mode in ("RGBA", "LA", "PA", "RGBa") or "transparency" in img.info
+
+
+def _to_8bit(img):
+    """将 16 位/32 位灰度图缩放为 8 位灰度图
+
+    带 16 位颜色键透明（tRNS）时返回 LA，透明像素的 alpha 为 0。
+    """
+    if img.mode == "F":
+        # 取值在 0.0~1.0 内按该范围处理，否则按实际最小/最大值拉伸到 0~255
+        lo, hi = img.getextrema()
+        if hi == lo:
+            # 纯色图无法拉伸，把该值限制到 0.0~1.0 后按该范围处理
+            return Image.new("L", img.size, round(min(max(lo, 0.0), 1.0) * 255))
+        if lo < 0.0 or hi > 1.0:
+            scale = 255 / (hi - lo)
+            return img.point(lambda v: (v - lo) * scale).convert("L")
+        return img.point(lambda v: v * 255).convert("L")
+    key = img.info.get("transparency")
+    if img.mode != "I":
+        img = img.convert("I")
+    # 按 65535 → 255 线性缩放，point 在 C 层一次完成
+    out = img.point(lambda v: v * (1 / 257)).convert("L")
+    # 原图的颜色键透明值是 16 位的，缩放后不再有效
+    out.info.pop("transparency", None)
+    if isinstance(key, int) and 0 <= key <= 0xFFFF:
+        # 按缩放前的 16 位值生成蒙版，缩放后其他像素可能与颜色键落到同一个 8 位值
+        lut = [255] * 0x10000
+        lut[key] = 0
+        out = Image.merge("LA", (out, img.point(lut, "L")))
+    return out
+
+
+def _cmyk_to_rgb(img):
+    """CMYK 转 RGB，有嵌入的 ICC 配置文件时优先使用色彩管理"""
+    icc = img.info.get("icc_profile")
+    if icc:
+        try:
+            src = ImageCms.ImageCmsProfile(io.BytesIO(icc))
+            dst = ImageCms.createProfile("sRGB")
+            return ImageCms.profileToProfile(img, src, dst, outputMode="RGB")
+        except (ImageCms.PyCMSError, OSError, ValueError):
+            pass
+    return img.convert("RGB")
+
+
+def flatten_alpha(img, background=DEFAULT_BACKGROUND):
+    """将带透明通道的图像合成到纯色背景上，返回 RGB 图像
+
+    RGBA 图只分配一张背景图，直接把源图作为蒙版粘贴（Pillow 在 C 层按 alpha 混合），
+    不额外复制整幅图像或拆分通道。其他模式需先转为 RGBA：Pillow 把 LA 粘贴到
+    RGB 时按原始字节复制，灰度值不会展开到三个通道。
+    """
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    canvas = Image.new("RGB", img.size, tuple(background))
+    canvas.paste(img, (0, 0), img)
+    return canvas
+
+
+def normalize_mode(img, save_format, background=DEFAULT_BACKGROUND):
+    """把图像转换为目标格式可以保存的模式
+
+    - JPEG：透明像素合成到 background 上，输出 RGB 或 L
+    - WEBP/AVIF：保留透明通道，输出 RGB 或 RGBA
+    - 16 位灰度缩放到 8 位，CMYK 转换为 RGB
+    """
+    if img.mode in ("I;16", "I;16L", "I;16B", "I;16N", "I", "F"):
+        img = _to_8bit(img)
+    elif img.mode == "CMYK":
+        img = _cmyk_to_rgb(img)
+
+    if save_format == "JPEG":
+        if _has_alpha(img):
+            return flatten_alpha(img, background)
+        if img.mode not in _JPEG_MODES:
+            return img.convert("RGB")
+        return img
+
+    if save_format in _ALPHA_FORMATS:
+        if _has_alpha(img):
+            return img if img.mode == "RGBA" else img.convert("RGBA")
+        return img if img.mode == "RGB" else img.convert("RGB")
+
+    return img
+
+
+def encode_image(img, save_format, quality, background=DEFAULT_BACKGROUND):
+    """将图像编码到内存，返回字节串"""
+    # 统一图像模式（透明合成、16位转8位、CMYK转RGB）
+    out_img = normalize_mode(img, save_format, background)
+
+    buf = io.BytesIO()
+    # 特殊处理JPG格式
+    if save_format == "JPEG":
+        out_img.save(buf, format=save_format, quality=quality, optimize=True)
+    else:
+        out_img.save(buf, format=save_format, quality=quality)
+    return buf.getvalue()
+
+
+def output_name(filepath, fmt):
+    """按源文件名和目标格式生成输出文件名"""
+    base_name = os.path.splitext(os.path.basename(filepath))[0]
+    return f"{base_name}.{fmt.lower()}"
+
+
+def backup_failed(filepath, err_dir, log):
+    """把处理失败的源文件备份到错误目录，结果通过 log(消息) 输出"""
+    filename = os.path.basename(filepath)
+    try:
+        shutil.copy(filepath, os.path.join(err_dir, f"error_{filename}"))
+        log(f"❌ 处理失败: {filename} (已备份到错误目录)")
+    except OSError:
+        log(f"❌ 处理失败且无法备份: {filename}")
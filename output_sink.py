@@ -0,0 +1,269 @@
+import abc
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+import uuid
+import zipfile
+
+try:
+    import zstandard  # 可选依赖，用于 tar.zst
+except ImportError:
+    zstandard = None
+
+
+# 归档内清单文件名
+MANIFEST_NAME = "manifest.json"
+
+
+class SinkError(Exception):
+    """输出目标写入失败，后续文件无法再写入"""
+
+
+class OutputSink(abc.ABC):
+    """输出目标基类：按顺序接收已编码好的文件数据
+
+    source_root 为输入文件的根目录，清单中的源文件路径记录为相对该目录的路径；
+    未指定时只记录文件名，避免把本机绝对路径写进交付的归档。
+    """
+
+    def __init__(self, location, source_root=""):
+        self.location = location
+        self.source_root = source_root
+        self.manifest = []
+        self.failed = False
+
+    @abc.abstractmethod
+    def exists(self, name):
+        """输出目标中是否已有同名文件"""
+
+    def write(self, name, data, source=""):
+        """写入一个输出文件，data 为编码后的字节串"""
+        self._write(name, data)
+        self.manifest.append({
+            "name": name,
+            "source": self._relative_source(source),
+            "size": len(data),
+            "sha256": hashlib.sha256(data).hexdigest(),
+        })
+
+    def _relative_source(self, source):
+        if not source:
+            return ""
+        if self.source_root:
+            try:
+                return os.path.relpath(source, self.source_root).replace(os.sep, "/")
+            except ValueError:
+                # Windows 下源文件与根目录不在同一盘符
+                pass
+        return os.path.basename(source)
+
+    @abc.abstractmethod
+    def _write(self, name, data):
+        """把数据写入输出目标"""
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class DirectorySink(OutputSink):
+    """默认输出目标：每个结果单独写入输出目录
+
+    exclusive 为 True 时不覆盖已有文件，目标已存在则抛出 FileExistsError，
+    多个进程同时写同名文件也只有一个能成功。目录支持硬链接时（atomic 为 True）
+    先写临时文件再链接到目标名；否则直接独占创建目标文件，中途退出可能留下残缺文件。
+    """
+
+    def __init__(self, location, source_root="", exclusive=False):
+        super().__init__(location, source_root)
+        self.exclusive = exclusive
+        self.atomic = exclusive and self._supports_link()
+
+    def _supports_link(self):
+        """检测输出目录是否支持硬链接（FAT/exFAT、部分 SMB/NAS、FUSE 挂载不支持）"""
+        probe = os.path.join(self.location, f".link-probe-{uuid.uuid4().hex}")
+        try:
+            os.makedirs(self.location, exist_ok=True)
+            with open(probe, "xb"):
+                pass
+            os.link(probe, probe + ".link")
+            return True
+        except OSError:
+            return False
+        finally:
+            for path in (probe, probe + ".link"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.location, name))
+
+    def _write(self, name, data):
+        os.makedirs(self.location, exist_ok=True)
+        path = os.path.join(self.location, name)
+        if not self.exclusive:
+            with open(path, "wb") as f:
+                f.write(data)
+            return
+
+        if not self.atomic:
+            # 不支持硬链接：直接独占创建目标文件，写入失败时删除
+            f = open(path, "xb")
+            try:
+                with f:
+                    f.write(data)
+            except BaseException:
+                os.remove(path)
+                raise
+            return
+
+        # 先写临时文件，再硬链接到目标文件名，目标已存在时原子地失败；
+        # 中途退出也不会在目标文件名下留下残缺的输出
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(tmp_path, "xb") as f:
+                f.write(data)
+            os.link(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class ArchiveSink(OutputSink):
+    """归档输出目标：所有结果顺序追加到一个归档文件，结束时写入清单
+
+    写入过程中使用 .part 临时文件，关闭后才重命名为最终文件名。
+    写入出错（如磁盘已满）后归档可能已损坏，write 抛出 SinkError，
+    之后不再追加任何条目，关闭时保留 .part 文件并将 location 指向它。
+    """
+
+    def __init__(self, location, source_root=""):
+        super().__init__(location, source_root)
+        self._names = set()
+        self._part_path = location + ".part"
+        self._closed = False
+
+    def exists(self, name):
+        return name in self._names
+
+    def write(self, name, data, source=""):
+        if self.failed:
+            raise SinkError("归档已写入失败，不能继续追加")
+        try:
+            super().write(name, data, source)
+        except OSError as e:
+            self.failed = True
+            raise SinkError(f"写入归档失败: {e}") from e
+        self._names.add(name)
+
+    def _manifest_bytes(self):
+        return json.dumps(self.manifest, ensure_ascii=False, indent=2).encode("utf-8")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.failed:
+            # 不写清单也不改名，保留 .part 文件供排查
+            try:
+                self._close_archive()
+            except OSError:
+                pass
+            self.location = self._part_path
+            return
+        try:
+            self._write(MANIFEST_NAME, self._manifest_bytes())
+        finally:
+            self._close_archive()
+        os.replace(self._part_path, self.location)
+
+    @abc.abstractmethod
+    def _close_archive(self):
+        """关闭归档文件"""
+
+
+class ZipSink(ArchiveSink):
+    """ZIP 归档（存储或 deflate 压缩）"""
+
+    def __init__(self, location, compression=zipfile.ZIP_STORED, source_root=""):
+        super().__init__(location, source_root)
+        self._zip = zipfile.ZipFile(self._part_path, "w", compression=compression)
+
+    def _write(self, name, data):
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = self._zip.compression
+        self._zip.writestr(info, data)
+
+    def _close_archive(self):
+        self._zip.close()
+
+
+class TarSink(ArchiveSink):
+    """TAR 归档，compression 为 "zst" 时输出 tar.zst"""
+
+    def __init__(self, location, compression="", source_root=""):
+        super().__init__(location, source_root)
+        self._raw = open(self._part_path, "wb")
+        self._zst = None
+        fileobj = self._raw
+        if compression == "zst":
+            if zstandard is None:
+                self._raw.close()
+                os.remove(self._part_path)
+                raise ValueError("未安装 zstandard，无法输出 tar.zst")
+            self._zst = zstandard.ZstdCompressor().stream_writer(self._raw)
+            fileobj = self._zst
+        # 流模式只顺序写入，不回头修改已写出的数据
+        self._tar = tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT)
+
+    def _write(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def _close_archive(self):
+        self._tar.close()
+        if self._zst is not None:
+            self._zst.close()
+        else:
+            self._raw.close()
+
+
+# 输出方式 -> (归档扩展名, 构造函数)；扩展名为空表示输出到目录
+SINK_TYPES = {
+    "文件夹": ("", DirectorySink),
+    "ZIP (存储)": (".zip", lambda path, root: ZipSink(path, zipfile.ZIP_STORED, root)),
+    "ZIP (压缩)": (".zip", lambda path, root: ZipSink(path, zipfile.ZIP_DEFLATED, root)),
+    "TAR": (".tar", lambda path, root: TarSink(path, "", root)),
+    "TAR.ZST": (".tar.zst", lambda path, root: TarSink(path, "zst", root)),
+}
+DEFAULT_SINK = "文件夹"
+
+
+def available_sinks():
+    """返回当前环境可用的输出方式"""
+    return [kind for kind in SINK_TYPES if kind != "TAR.ZST" or zstandard is not None]
+
+
+def create_sink(kind, out_dir, source_root=""):
+    """在输出目录下创建指定类型的输出目标"""
+    ext, factory = SINK_TYPES[kind]
+    if not ext:
+        return factory(out_dir, source_root)
+    os.makedirs(out_dir, exist_ok=True)
+    name = time.strftime("转换结果_%Y%m%d_%H%M%S")
+    path = os.path.join(out_dir, name + ext)
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(out_dir, f"{name}_{suffix}{ext}")
+        suffix += 1
+    return factory(path, source_root)
@@ -0,0 +1,532 @@
+"""多进程分片批处理
+
+在共享工作目录中按分片执行同一个转换任务，可在一台或多台挂载同一存储的机器上
+同时启动多个工作进程：
+
+    python shard_runner.py init 任务目录 --format JPG --out 输出目录 -i 图片...
+    python shard_runner.py work 任务目录          # 每个工作进程执行一次
+    python shard_runner.py merge 任务目录         # 汇总各分片报告
+    python shard_runner.py run 任务目录 -n 4      # 本机启动 4 个工作进程并汇总
+"""
+import argparse
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from PIL import Image
+import pillow_avif  # 插件自动注册支持AVIF
+from image_ops import (
+    DEFAULT_BACKGROUND, ERROR_DIR_NAME, FORMAT_MAP, backup_failed, encode_image, output_name
+)
+from output_sink import DirectorySink
+
+
+JOB_FILE = "job.json"
+SUMMARY_FILE = "summary.json"
+LEASE_DIR = "leases"
+PROGRESS_DIR = "progress"
+REPORT_DIR = "reports"
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_LEASE_TTL = 300  # 秒，租约超过该时间未续期即视为工作进程已退出
+
+
+def log(message):
+    print(message, flush=True)
+
+
+def write_json(path, data):
+    """原子写入 JSON 文件（先写临时文件再重命名）"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def parse_color(value):
+    """把 #rrggbb 解析为 (r, g, b)"""
+    value = value.lstrip("#")
+    if len(value) != 6:
+        raise argparse.ArgumentTypeError(f"无效的颜色: {value}")
+    try:
+        return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的颜色: {value}")
+
+
+def init_job(job_dir, files, fmt, quality, out_dir,
+             background=DEFAULT_BACKGROUND, chunk_size=DEFAULT_CHUNK_SIZE):
+    """创建任务目录并写入任务清单"""
+    if fmt not in FORMAT_MAP:
+        raise ValueError(f"不支持的输出格式: {fmt}")
+    if not files:
+        raise ValueError("任务中没有输入文件")
+    if chunk_size < 1:
+        raise ValueError("分片大小必须大于 0")
+
+    job_path = os.path.join(job_dir, JOB_FILE)
+    if os.path.exists(job_path):
+        raise FileExistsError(f"任务已存在: {job_path}")
+
+    for name in (LEASE_DIR, PROGRESS_DIR, REPORT_DIR):
+        os.makedirs(os.path.join(job_dir, name), exist_ok=True)
+    job = {
+        "format": fmt,
+        "quality": quality,
+        "background": list(background),
+        "out_dir": os.path.abspath(out_dir),
+        "chunk_size": chunk_size,
+        "chunks": (len(files) + chunk_size - 1) // chunk_size,
+        "files": [os.path.abspath(f) for f in files],
+    }
+    write_json(job_path, job)
+    return job
+
+
+def load_job(job_dir):
+    return read_json(os.path.join(job_dir, JOB_FILE))
+
+
+def chunk_files(job, index):
+    size = job["chunk_size"]
+    return job["files"][index * size:(index + 1) * size]
+
+
+def report_path(job_dir, index):
+    return os.path.join(job_dir, REPORT_DIR, f"chunk_{index:06d}.json")
+
+
+def progress_path(job_dir, index):
+    return os.path.join(job_dir, PROGRESS_DIR, f"chunk_{index:06d}.jsonl")
+
+
+class LeaseLost(Exception):
+    """租约已被其他进程接管"""
+
+
+class Lease:
+    """分片租约：以 O_EXCL 创建租约文件实现原子抢占，后台线程定期更新 mtime 续期
+
+    租约文件的 mtime 超过 ttl 秒未更新时视为持有者已退出，其他进程可以接管。
+    每次持有都会写入唯一令牌，续期和释放前核对令牌，不会误续或误删别人的租约。
+    接管过期租约前先以 O_EXCL 创建该代租约专属的接管标记，同一代只有一个进程能接管。
+    多台机器共享存储时需保证各机器时钟大致同步。
+    """
+
+    def __init__(self, job_dir, index, worker_id, ttl=DEFAULT_LEASE_TTL):
+        self.path = os.path.join(job_dir, LEASE_DIR, f"chunk_{index:06d}.lease")
+        self.worker_id = worker_id
+        self.token = f"{worker_id}-{uuid.uuid4().hex}"
+        self.ttl = ttl
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.ttl
+        except FileNotFoundError:
+            return True
+
+    def _read_token(self, path):
+        try:
+            return read_json(path).get("token")
+        except (OSError, ValueError, AttributeError):
+            # 文件不存在，或持有者刚创建尚未写完
+            return None
+
+    def _generation(self):
+        """当前租约的代号：正常为令牌，持有者创建后未写完就退出时用 mtime 代替"""
+        token = self._read_token(self.path)
+        if token is not None:
+            return token
+        try:
+            return f"mtime-{os.stat(self.path).st_mtime_ns}"
+        except FileNotFoundError:
+            return None
+
+    def _lease_data(self):
+        return {
+            "token": self.token,
+            "worker": self.worker_id,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "acquired": time.time(),
+        }
+
+    def _create(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self._lease_data(), f)
+        return True
+
+    def _take_over(self):
+        """接管已过期的租约，成功返回 True"""
+        generation = self._generation()
+        if generation is None or not self._expired(self.path):
+            return False
+
+        # 以过期代号命名的接管标记，同一代租约只有一个进程能创建成功
+        digest = hashlib.sha1(generation.encode("utf-8")).hexdigest()
+        marker = f"{self.path}.{digest}.takeover"
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            return False
+        try:
+            if self._generation() != generation:
+                # 创建标记前租约已被释放并重新获取，不再是过期的那一代
+                return False
+            write_json(self.path, self._lease_data())
+        finally:
+            os.remove(marker)
+        return True
+
+    def acquire(self):
+        """尝试获取租约，成功后启动后台续期线程"""
+        if not (self._create() or self._take_over()):
+            return False
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _beat(self):
+        # 单个大文件的编码可能超过 ttl，处理期间在后台持续续期
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.renew()
+            except LeaseLost:
+                self.lost = True
+                return
+
+    def check(self):
+        """租约已被接管时抛出 LeaseLost"""
+        if self.lost:
+            raise LeaseLost(f"分片租约已被其他进程接管: {os.path.basename(self.path)}")
+
+    def renew(self):
+        """续期租约，租约已被接管时抛出 LeaseLost"""
+        if self._read_token(self.path) != self.token:
+            raise LeaseLost(f"分片租约已被其他进程接管: {os.path.basename(self.path)}")
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            raise LeaseLost(f"分片租约已被其他进程接管: {os.path.basename(self.path)}")
+
+    def release(self):
+        """停止续期并释放租约，只删除仍属于本进程的租约文件"""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if self._read_token(self.path) != self.token:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def load_progress(path):
+    """读取分片进度记录，返回 {输入文件: 最后一条记录}"""
+    records = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 进程中途退出留下的半行记录
+                    continue
+                records[record["file"]] = record
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def written_by_other(path, filepath, owner):
+    """进度记录中是否有同一分片的其他持有者写出过该文件"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if (record["file"] == filepath and record.get("owner") != owner
+                    and record["status"] in ("writing", "success")):
+                return True
+    return False
+
+
+def append_progress(f, record):
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def convert_file(job, filepath, sink, err_dir, progress, resumed, owner):
+    """转换单个文件，返回进度记录
+
+    resumed 表示之前的持有者已开始写这个文件但未记录完成。输出目录支持原子写入时，
+    已存在的目标文件即为本任务写出的完整结果，计为成功；否则可能只写了一半，删除后重新转换。
+    """
+    filename = os.path.basename(filepath)
+    out_name = output_name(filepath, job["format"])
+    record = {"file": filepath, "out": out_name, "owner": owner}
+    try:
+        if sink.exists(out_name):
+            if resumed and sink.atomic:
+                record["status"] = "success"
+                return record
+            if resumed:
+                os.remove(os.path.join(sink.location, out_name))
+            elif written_by_other(progress.name, filepath, owner):
+                # 租约被接管前后，同一分片的另一个持有者已写出该文件
+                record["status"] = "success"
+                return record
+            else:
+                # 任务开始前已存在的文件，或已被同名的其他输入文件写出
+                log(f"ℹ️ 跳过: {filename} (目标文件已存在)")
+                record["status"] = "skipped"
+                return record
+
+        with Image.open(filepath) as img:
+            data = encode_image(img, FORMAT_MAP[job["format"]], job["quality"], tuple(job["background"]))
+
+        append_progress(progress, dict(record, status="writing"))
+        try:
+            sink.write(out_name, data, filepath)
+        except FileExistsError:
+            if written_by_other(progress.name, filepath, owner):
+                # 租约被接管前后，同一分片的另一个持有者已写出该文件
+                record["status"] = "success"
+                return record
+            # 其他分片中同名的输入文件（如 a.png 与 a.webp）已先写出
+            log(f"ℹ️ 跳过: {filename} (目标文件已存在)")
+            record["status"] = "skipped"
+            return record
+        record["status"] = "success"
+
+    except Exception as e:
+        # 单个文件的任何错误（包括解压炸弹、延迟解码错误）都只记录，不中断工作进程
+        backup_failed(filepath, err_dir, log)
+        record.update(status="fail", type=type(e).__name__, message=str(e))
+    return record
+
+
+def convert_chunk(job, job_dir, index, sink, err_dir, lease, worker_id):
+    """转换一个分片，返回分片报告
+
+    每个文件处理完都会追加一条进度记录，接管已退出进程的分片时沿用其中的结果。
+    """
+    files = chunk_files(job, index)
+    path = progress_path(job_dir, index)
+    records = load_progress(path)
+
+    with open(path, "a", encoding="utf-8") as progress:
+        for filepath in files:
+            lease.check()
+            previous = records.get(filepath)
+            if previous is not None and previous["status"] != "writing":
+                continue
+            record = convert_file(job, filepath, sink, err_dir, progress, previous is not None, lease.token)
+            append_progress(progress, record)
+            records[filepath] = record
+
+    report = {
+        "chunk": index,
+        "worker": worker_id,
+        "total": len(files),
+        "success": 0,
+        "fail": 0,
+        "skipped": 0,
+        "errors": [],
+    }
+    for filepath in files:
+        record = records[filepath]
+        report[record["status"]] += 1
+        if record["status"] == "fail":
+            report["errors"].append({
+                "file": filepath,
+                "type": record["type"],
+                "message": record["message"],
+            })
+    report["finished"] = time.time()
+    return report
+
+
+def run_worker(job_dir, worker_id=None, ttl=DEFAULT_LEASE_TTL, poll=5):
+    """循环领取分片直到所有分片都有报告，返回本进程完成的分片数"""
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    job = load_job(job_dir)
+    sink = DirectorySink(job["out_dir"], exclusive=True)
+    if not sink.atomic:
+        log(f"⚠️ [{worker_id}] 输出目录不支持硬链接，改为直接独占创建输出文件")
+    err_dir = os.path.join(job["out_dir"], ERROR_DIR_NAME)
+    os.makedirs(err_dir, exist_ok=True)
+    os.makedirs(os.path.join(job_dir, PROGRESS_DIR), exist_ok=True)
+
+    done = 0
+    while True:
+        pending = [i for i in range(job["chunks"]) if not os.path.exists(report_path(job_dir, i))]
+        if not pending:
+            break
+
+        claimed = False
+        for index in pending:
+            lease = Lease(job_dir, index, worker_id, ttl)
+            if not lease.acquire():
+                continue
+            claimed = True
+            try:
+                # 获取租约后再确认一次，避免重复处理刚完成的分片
+                if os.path.exists(report_path(job_dir, index)):
+                    continue
+                log(f"🔧 [{worker_id}] 处理分片 {index + 1}/{job['chunks']}")
+                report = convert_chunk(job, job_dir, index, sink, err_dir, lease, worker_id)
+                # 写报告前确认租约仍归本进程
+                lease.renew()
+                write_json(report_path(job_dir, index), report)
+                done += 1
+            except LeaseLost as e:
+                log(f"⚠️ [{worker_id}] {e}，停止处理该分片")
+            finally:
+                lease.release()
+
+        # 剩余分片都被其他进程持有，等待其完成或租约过期
+        if not claimed:
+            time.sleep(min(poll, ttl))
+
+    log(f"✅ [{worker_id}] 完成 {done} 个分片")
+    return done
+
+
+def merge_reports(job_dir):
+    """汇总各分片报告，写入 summary.json 并返回汇总结果"""
+    job = load_job(job_dir)
+    summary = {
+        "total": len(job["files"]),
+        "success": 0,
+        "fail": 0,
+        "skipped": 0,
+        "missing_chunks": [],
+        "errors": [],
+        "origin_dir": os.path.dirname(job["files"][0]),
+        "out_dir": job["out_dir"],
+        "err_dir": os.path.join(job["out_dir"], ERROR_DIR_NAME),
+    }
+    for index in range(job["chunks"]):
+        path = report_path(job_dir, index)
+        if not os.path.exists(path):
+            summary["missing_chunks"].append(index)
+            continue
+        report = read_json(path)
+        for key in ("success", "fail", "skipped"):
+            summary[key] += report[key]
+        summary["errors"].extend(report["errors"])
+
+    write_json(os.path.join(job_dir, SUMMARY_FILE), summary)
+    return summary
+
+
+def print_summary(summary):
+    log("=" * 60)
+    log("✨ 转换完成!")
+    log(f"📊 总数: {summary['total']}")
+    log(f"✅ 成功: {summary['success']}")
+    log(f"❌ 失败: {summary['fail']}")
+    if summary["skipped"]:
+        log(f"ℹ️ 跳过: {summary['skipped']}")
+    if summary["missing_chunks"]:
+        log(f"⚠️ 未完成分片: {len(summary['missing_chunks'])}")
+    log(f"📂 原路径: {summary['origin_dir']}")
+    log(f"📁 输出路径: {summary['out_dir']}")
+    log(f"⚠️ 错误路径: {summary['err_dir']}")
+    log("=" * 60)
+
+
+def run_local(job_dir, workers, ttl=DEFAULT_LEASE_TTL):
+    """在本机启动多个工作进程，全部退出后汇总结果"""
+    host = socket.gethostname()
+    procs = [
+        subprocess.Popen([
+            sys.executable, os.path.abspath(__file__), "work", job_dir,
+            "--worker-id", f"{host}-{i}", "--lease-ttl", str(ttl),
+        ])
+        for i in range(workers)
+    ]
+    for proc in procs:
+        proc.wait()
+    return merge_reports(job_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多进程分片批量图片转换")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_init = sub.add_parser("init", help="创建任务")
+    p_init.add_argument("job_dir")
+    p_init.add_argument("-i", "--input", nargs="+", action="extend", default=[],
+                        help="输入文件")
+    p_init.add_argument("--list", help="输入文件列表，每行一个路径")
+    p_init.add_argument("--format", default="JPG", choices=list(FORMAT_MAP))
+    p_init.add_argument("--quality", type=int, default=80)
+    p_init.add_argument("--out", required=True, help="输出目录")
+    p_init.add_argument("--background", type=parse_color, default=DEFAULT_BACKGROUND,
+                        help="JPG 透明背景填充色，如 #ffffff")
+    p_init.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+
+    for name, help_text in (("work", "启动一个工作进程"), ("run", "本机启动多个工作进程并汇总")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("job_dir")
+        p.add_argument("--lease-ttl", type=int, default=DEFAULT_LEASE_TTL)
+        if name == "work":
+            p.add_argument("--worker-id")
+        else:
+            p.add_argument("-n", "--workers", type=int, default=os.cpu_count() or 1)
+
+    p_merge = sub.add_parser("merge", help="汇总分片报告")
+    p_merge.add_argument("job_dir")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "init":
+        files = list(args.input)
+        if args.list:
+            with open(args.list, encoding="utf-8") as f:
+                files.extend(line.strip() for line in f if line.strip())
+        try:
+            job = init_job(args.job_dir, files, args.format, args.quality, args.out,
+                           args.background, args.chunk_size)
+        except (ValueError, FileExistsError) as e:
+            parser.error(str(e))
+        log(f"🛠️ 已创建任务: {len(job['files'])} 个文件，{job['chunks']} 个分片")
+        return 0
+
+    if args.command == "work":
+        run_worker(args.job_dir, args.worker_id, args.lease_ttl)
+        return 0
+
+    if args.command == "run":
+        summary = run_local(args.job_dir, args.workers, args.lease_ttl)
+    else:
+        summary = merge_reports(args.job_dir)
+    print_summary(summary)
+    return 1 if summary["missing_chunks"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())